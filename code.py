@@ -4,17 +4,20 @@ from the output of a bbc micro keyboard and handle as a normal
 HID keyboard.
 """
 
-import time
-
 import digitalio
 import board
+import memorymap
 import pwmio
+from supervisor import ticks_ms
 from adafruit_debouncer import Debouncer
 import usb_hid
 from adafruit_hid.keyboard import Keyboard
 from adafruit_hid.keyboard_layout_us import KeyboardLayoutUS
 from adafruit_hid.keycode import Keycode
 
+# print key changes to the serial console, this blocks on USB so slows the scan
+DEBUG = False
+
 
 class Shifted:
     """
@@ -115,51 +118,174 @@ keys[6][9] = Keycode.WINDOWS
 
 keys[6][2] = Keycode.SPACEBAR
 
+# flatten into a single table indexed by (row << 4) | column
+# so a scan hit is one tuple lookup rather than two dict lookups
+KEYS = [None] * 128
+for r, row_keys in keys.items():
+    for c, kc in row_keys.items():
+        KEYS[(r << 4) | c] = kc
+KEYS = tuple(KEYS)
+del keys, r, c, row_keys, kc
+
+# scan state is a list of rows, each an int with bit column set for each
+# pressed key, kept to 16 bits so they stay small ints and don't allocate
+# this maps a single set bit back to its column
+COLUMN_BITS = {1 << c: c for c in range(16)}
+# bits for the positions that have a key, for each row
+KEY_MASK = tuple(
+    sum(1 << c for c in range(16) if KEYS[(r << 4) | c] is not None)
+    for r in range(8)
+)
+
+
+TICKS_PERIOD = 1 << 29
+TICKS_MAX = TICKS_PERIOD - 1
+TICKS_HALFPERIOD = TICKS_PERIOD // 2
+
 
-def int_to_bin(v: int, max: int):
+def ticks_diff(ticks1: int, ticks2: int) -> int:
     """
-    Convert integer to sequence of boolean values
+    Milliseconds from ticks2 to ticks1, allowing for ticks_ms wrapping around
     """
-    s = "{:0{0}b}".replace("{0}", str(max))
-    return [True if int(x) else False for x in s.format(v)]
+    diff = (ticks1 - ticks2) & TICKS_MAX
+    return ((diff + TICKS_HALFPERIOD) & TICKS_MAX) - TICKS_HALFPERIOD
 
 
 def megahertz_clock(func: function, delay_factor: int = 1):
     """
-    Run the passed in function at 1 megahertz
+    Run the passed in function at (at most) 1 megahertz
+    Rather than reading the clock every call, check every 1024 calls
+    that at least delay_factor milliseconds have gone by
     """
-    previous = 0
+    count = 0
+    previous = ticks_ms()
     while True:
-        current_time = time.monotonic_ns()
-        if (previous + (100 * delay_factor)) < current_time:
-            previous = current_time
-            func()
+        func()
+        count = (count + 1) & 0x3FF
+        if count == 0:
+            while ticks_diff(ticks_ms(), previous) < delay_factor:
+                pass
+            previous = ticks_ms()
+
+
+# RP2040 single-cycle IO block, writing a mask to GPIO_OUT_SET/CLR
+# changes several pins at once without going through digitalio
+SIO = memorymap.AddressRange(start=0xD0000000, length=0x20)
+GPIO_OUT_SET = slice(0x14, 0x18)
+GPIO_OUT_CLR = slice(0x18, 0x1C)
+
+
+def gpio_pin(number: int):
+    """
+    Board pin for a GPIO number, so the number can be kept for register masks
+    """
+    return getattr(board, "GP{}".format(number))
+
+
+def register_value(mask: int) -> bytes:
+    """
+    Convert a pin mask into the bytes written to a SIO register
+    """
+    return mask.to_bytes(4, "little")
+
+
+def gpio_mask(numbers) -> int:
+    """
+    Bit mask with a bit set for each GPIO number
+    """
+    mask = 0
+    for n in numbers:
+        mask |= 1 << n
+    return mask
+
+
+def pin_masks(numbers, options: int):
+    """
+    Set and clear register values for each value a group of pins can show,
+    as two tuples indexed by the value
+    First pin is the most significant bit
+    """
+    set_masks = []
+    clear_masks = []
+    for v in range(options):
+        on = [n for i, n in enumerate(reversed(numbers)) if v & (1 << i)]
+        off = [n for n in numbers if n not in on]
+        set_masks.append(register_value(gpio_mask(on)))
+        clear_masks.append(register_value(gpio_mask(off)))
+    return tuple(set_masks), tuple(clear_masks)
+
+
+def scan_matrix(
+    sio, out_set, out_clr, clock, w_line, col_on, col_off, row_on, row_off, state
+):
+    """
+    Step through every row and column combo, filling state with the
+    pressed keys as a list of rows with a bit per column (see COLUMN_BITS)
+    state is reused between scans so the scan doesn't allocate
+    Everything is passed in so the loop only touches locals
+    """
+    row_count = len(row_on)
+    for rx in range(row_count):
+        state[rx] = 0
+    for cx in range(len(col_on)):
+        # set column pin values
+        sio[out_set] = col_on[cx]
+        sio[out_clr] = col_off[cx]
+        for rx in range(row_count):
+            # set row in values
+            sio[out_set] = row_on[rx]
+            sio[out_clr] = row_off[rx]
+
+            # seem to need to pulse the clock to latch the columns
+            sio[out_clr] = clock
+            sio[out_set] = clock
+
+            # see if we have a return value
+            if w_line.value:
+                state[rx] |= 1 << cx
 
 
 class HIDKeyboard:
-  """
-  Quick wrapper for HID interface
-  """
+    """
+    Quick wrapper for HID interface
+    """
     def __init__(self):
         self.keyboard = Keyboard(usb_hid.devices)
         self.keyboard_layout = KeyboardLayoutUS(self.keyboard)
-        self.shift_down = False
+        self.caps_lock_on = None
 
-    def key_press(self, value):
-        if isinstance(value, str):
-            self.keyboard_layout.write(value)
-        else:
-            self.keyboard.press(value)
-        if value == Keycode.SHIFT:
-            self.shift_down = True
+    def key_press_keycode(self, value):
+        self.keyboard.press(value)
+
+    def key_press_unshifted(self, value):
+        """
+        Press a key with shift left out of that one report
+        Shift goes back into the report afterwards so the next report
+        shows it as held again, saving a release and press of shift
+        """
+        # relies on adafruit_hid Keyboard private members
+        # (_add_keycode_to_report, _keyboard_device), check these on upgrade
+        keyboard = self.keyboard
+        modifier = keyboard.report_modifier[0]
+        keyboard.report_modifier[0] = modifier & ~Keycode.modifier_bit(Keycode.SHIFT)
+        try:
+            keyboard._add_keycode_to_report(value)
+            keyboard._keyboard_device.send_report(keyboard.report)
+        finally:
+            keyboard.report_modifier[0] |= modifier
+
+    def write_string(self, value: str):
+        self.keyboard_layout.write(value)
 
     def key_release(self, value):
         self.keyboard.release(value)
-        if value == Keycode.SHIFT:
-            self.shift_down = False
 
     def align_leds(self):
-        LED.caps_lock.set(self.keyboard.led_on(Keyboard.LED_CAPS_LOCK))
+        # only touch the pin when the host changes the caps lock state
+        caps_lock_on = self.keyboard.led_on(Keyboard.LED_CAPS_LOCK)
+        if caps_lock_on != self.caps_lock_on:
+            LED.caps_lock.set(caps_lock_on)
+            self.caps_lock_on = caps_lock_on
 
 
 bbc_keyboard = HIDKeyboard()
@@ -167,24 +293,97 @@ bbc_keyboard = HIDKeyboard()
 
 class DebounceInput:
     """
-    Modern keyboards seem to have a varying bounce
-    Long for the first time, but then lesser after that    
+    Eager debounce for each key
+    A change is passed on straight away, then that key ignores
+    further changes for a few scans while the contacts settle
     """
 
-    def __init__(self, delay=0.15, short_delay=0.09):
-        self.queue = {}
-        self.short_queue = {}
-        self.recent_release = None
-        self.delay = delay
-        self.short_delay = short_delay
-        self.no_input_registered = False
+    def __init__(self, scans: int = 5):
+        self.scans = scans
+        # scans left before each key (index into KEYS) can change again
+        self.countdown = bytearray(len(KEYS))
+        self.cooling = 0
+        # keys reported as down, one int per row, see COLUMN_BITS
+        self.state = [0] * len(KEY_MASK)
+        # what was pressed for each key that is down
+        self.sent = [None] * len(KEYS)
+        # the physical shift key, the HID shift modifier can be
+        # dropped for a moment while sending a Shifted key
+        self.shift_held = False
+
+    def input(self, state):
+        """
+        take the state of the matrix from a scan, as a list of rows
+        any change held back while a key was settling is picked up here
+        once its countdown runs out
+        """
+        self.check()
+        current = self.state
+        countdown = self.countdown
+        for rx in range(len(current)):
+            changed = (state[rx] & KEY_MASK[rx]) ^ current[rx]
+            while changed:
+                bit = changed & -changed
+                index = (rx << 4) | COLUMN_BITS[bit]
+                if not countdown[index]:
+                    self.change(index)
+                changed ^= bit
+
+    def change(self, index: int):
+        """
+        report a key as having gone down or up
+        """
+        # add more processing here
+        if DEBUG:
+            print("row:", index >> 4, "column:", index & 0xF, "keycode:", KEYS[index])
+        row = index >> 4
+        bit = 1 << (index & 0xF)
+        self.state[row] ^= bit
+        if self.state[row] & bit:
+            self.sent[index] = self.press(KEYS[index])
+        else:
+            self.release(self.sent[index])
+            self.sent[index] = None
+        self.countdown[index] = self.scans
+        self.cooling += 1
 
-    def input(self, value, shift=False):
-        now = time.monotonic()
+    def release_all(self):
+        """
+        release every key that is down, without starting any countdowns
+        the hardware scan can't see row 0 (shift, ctrl), so these may still be
+        held and need to go straight back down on the next scan
+        """
+        sent = self.sent
+        for index in range(len(sent)):
+            if sent[index] is not None:
+                self.release(sent[index])
+                sent[index] = None
+        state = self.state
+        for rx in range(len(state)):
+            state[rx] = 0
+
+    def check(self):
+        """
+        count down keys that are settling, once per scan
+        """
+        if not self.cooling:
+            return
+        countdown = self.countdown
+        for index in range(len(countdown)):
+            if countdown[index]:
+                countdown[index] -= 1
+                if not countdown[index]:
+                    self.cooling -= 1
+
+    def press(self, value, shift=False):
+        """
+        send a key down, returns what was sent so it can be released
+        """
+        if value == Keycode.SHIFT:
+            self.shift_held = True
         shift_escape = False
-        self.no_input_registered = False
         if isinstance(value, AltShift):
-            if bbc_keyboard.shift_down:
+            if self.shift_held:
                 value = value.alt_key
                 shift_escape = True
             else:
@@ -192,49 +391,35 @@ class DebounceInput:
         if shift and value == Keycode.BACKSPACE:
             # process shift + break here
             print("SHIFT + BREAK")
+        self.key_down(value, shift_escape)
+        return value
 
-        if value not in self.queue:
-            self.key_down(value, shift_escape)
-            self.queue[value] = now
-
-    def check(self):
-        """
-        see if any keypresses should be said to have expired
-        """
-
-        current_time = time.monotonic()
-        for k, v in self.queue.items():
-            if self.no_input_registered:
-                delay = self.delay / 2
-            else:
-                delay = self.delay
-            if k == self.recent_release:
-                delay = self.short_delay
-            if v + delay < current_time:
-                self.key_up(k)
-                self.recent_release = k
-                del self.queue[k]
-
-    def no_input(self):
-        self.no_input_registered = True
+    def release(self, value):
+        if value == Keycode.SHIFT:
+            self.shift_held = False
+        self.key_up(value)
 
     def key_down(self, value, shift_escape=False):
         # this should interface with hid keyboard
-        if shift_escape:
-            bbc_keyboard.key_release(Keycode.SHIFT)
         if isinstance(value, Shifted):
-            bbc_keyboard.key_press(Keycode.SHIFT)
-            bbc_keyboard.key_press(value.key)
-            bbc_keyboard.key_release(Keycode.SHIFT)
+            if self.shift_held:
+                # shift is already held, so the key on its own does it
+                bbc_keyboard.key_press_keycode(value.key)
+            else:
+                bbc_keyboard.key_press_keycode(Keycode.SHIFT)
+                bbc_keyboard.key_press_keycode(value.key)
+                bbc_keyboard.key_release(Keycode.SHIFT)
+        elif shift_escape:
+            bbc_keyboard.key_press_unshifted(value)
         else:
-            bbc_keyboard.key_press(value)
-        if shift_escape:
-            bbc_keyboard.key_press(Keycode.SHIFT)
+            bbc_keyboard.key_press_keycode(value)
 
     def key_up(self, value):
         # this should interface with hid keyboard
         if isinstance(value, Shifted):
-            bbc_keyboard.key_release(Keycode.SHIFT)
+            # leave shift alone if it is physically held
+            if not self.shift_held:
+                bbc_keyboard.key_release(Keycode.SHIFT)
             bbc_keyboard.key_release(value.key)
         else:
             bbc_keyboard.key_release(value)
@@ -258,17 +443,37 @@ class BreakButtonProcessor:
         self.input = Input(pin)
         self.switch = Debouncer(self.input.input)
         self.label = label
+        self.last_check = ticks_ms()
 
     def check(self):
+        # no need to look more than once a millisecond, leave the time for the scan
+        now = ticks_ms()
+        if ticks_diff(now, self.last_check) < 1:
+            return
+        self.last_check = now
         self.switch.update()
-        if not self.input.tripped():
+        # pulled up, so pressing the button takes the input low
+        # the debouncer has already settled the button, so skip the countdown
+        if self.switch.fell:
             shift = bbc.ss.check_shift()
-            input_processor.input(self.label, shift=shift)
+            input_processor.press(self.label, shift=shift)
+        elif self.switch.rose:
+            input_processor.release(self.label)
+
+
+def output_pin(pin: board.PIN) -> digitalio.DigitalInOut:
+    """
+    Plain DigitalInOut output for the scan lines, which are never reversed
+    """
+    output = digitalio.DigitalInOut(pin)
+    output.direction = digitalio.Direction.OUTPUT
+    return output
 
 
 class Output:
     """
     Wrapper around DigitalInOut that handles some reversed outputs
+    Used for the LEDs
     """
 
     def __init__(self, pin: board.PIN, reverse: bool = False):
@@ -301,16 +506,19 @@ class HardwareScan:
     But it's nice to use the way designed
     """
 
-    clock = Output(board.GP1)
+    clock_gpio = 1
+    clock = output_pin(gpio_pin(clock_gpio))
+    clock_mask = register_value(1 << clock_gpio)
     interrupt = Input(pin=board.GP12)  # ca2
 
     def __init__(self):
         SoftwareScan.kb_en.value = True
         self.absence_count = 0
+        self.led_poll = 0
 
     def check(self, trigger_func: function, absence_func: function):
         if HardwareScan.interrupt.tripped():
-            HardwareScan.clock.set_off()
+            HardwareScan.clock.value = False
             # oh boy a keypress, here we go here we go
             trigger_func()
             self.absence_count = 0
@@ -320,9 +528,13 @@ class HardwareScan:
                 absence_func()
                 self.absence_count = 0
         # send the clock pulse
-        HardwareScan.clock.set_off()
-        HardwareScan.clock.set_on()
-        bbc_keyboard.align_leds()
+        clock = HardwareScan.clock_mask
+        SIO[GPIO_OUT_CLR] = clock
+        SIO[GPIO_OUT_SET] = clock
+        # asking usb_hid for the LED state is slow, so only do it every 256 checks
+        self.led_poll = (self.led_poll + 1) & 0xFF
+        if self.led_poll == 0:
+            bbc_keyboard.align_leds()
 
 
 class SoftwareScan:
@@ -334,46 +546,38 @@ class SoftwareScan:
     kb_en needs to be set off for the software scan to work.
     """
 
-    row_pins = list(map(Output, [board.GP5, board.GP4, board.GP3]))
-    col_pins = list(map(Output, [board.GP9, board.GP8, board.GP7, board.GP6]))
+    row_gpios = (5, 4, 3)
+    col_gpios = (9, 8, 7, 6)
+    kb_en_gpio = 2
+    row_pins = [output_pin(gpio_pin(n)) for n in row_gpios]
+    col_pins = [output_pin(gpio_pin(n)) for n in col_gpios]
     w_line = Input(pin=board.GP10, pull=digitalio.Pull.DOWN)
-    kb_en = Output(board.GP2)
+    kb_en = output_pin(gpio_pin(kb_en_gpio))
+    kb_en_mask = register_value(1 << kb_en_gpio)
     max_rows = 2 ** len(row_pins)
     max_columns = 2 ** len(col_pins)
 
     def __init__(self):
-
-        col_pin_count = len(SoftwareScan.col_pins)
-        row_pin_count = len(SoftwareScan.row_pins)
-
-        self.r_opts = [int_to_bin(x, row_pin_count) for x in range(2 ** row_pin_count)]
-        self.c_opts = [int_to_bin(x, col_pin_count) for x in range(2 ** col_pin_count)]
-
-        def part_zip(pins, options):
-            for o in options:
-                yield list(zip(pins, o))
-
-        self.col_with_options = list(
-            enumerate(list(part_zip(SoftwareScan.col_pins, self.c_opts)))
+        self.col_on, self.col_off = pin_masks(
+            SoftwareScan.col_gpios, SoftwareScan.max_columns
         )
-
-        self.row_with_options = list(
-            enumerate(list(part_zip(SoftwareScan.row_pins, self.r_opts)))
+        self.row_on, self.row_off = pin_masks(
+            SoftwareScan.row_gpios, SoftwareScan.max_rows
         )
+        # kb_en and every row/column pin off
+        self.shift_mask = register_value(
+            gpio_mask(
+                (SoftwareScan.kb_en_gpio,)
+                + SoftwareScan.row_gpios
+                + SoftwareScan.col_gpios
+            )
+        )
+        # filled in by each scan, see scan_matrix
+        self.state = [0] * SoftwareScan.max_rows
 
     def no_input(self):
-        input_processor.no_input()
-
-    def process(self, row: int, column: int):
-        # add more processing here
-        try:
-            keycode = keys[row][column]
-        except Exception:
-            keycode = None
-
-        print(f"row: {row}, column: {column}, keycode: {keycode}")
-        if keycode:
-            input_processor.input(keycode)
+        # nothing has tripped the hardware scan for a while, so no keys are down
+        input_processor.release_all()
 
     def check_shift(self):
         """
@@ -381,43 +585,43 @@ class SoftwareScan:
         # shift is at 0 cols and 0 rows
         """
 
-        SoftwareScan.kb_en.output.value = False
-        for pin in SoftwareScan.col_pins:
-            pin.output.value = False
-        for pin in SoftwareScan.row_pins:
-            pin.output.value = False
+        sio = SIO
+        clock = HardwareScan.clock_mask
 
-        HardwareScan.clock.output.value = False
-        HardwareScan.clock.output.value = True
+        sio[GPIO_OUT_CLR] = self.shift_mask
+
+        sio[GPIO_OUT_CLR] = clock
+        sio[GPIO_OUT_SET] = clock
 
         value = bool(SoftwareScan.w_line.input.value)
-        SoftwareScan.kb_en.output.value = True
+        sio[GPIO_OUT_SET] = SoftwareScan.kb_en_mask
         return value
 
     def check(self):
         """
         check all row and column combos for an active keypress
         """
-        SoftwareScan.kb_en.output.value = False
-
-        for cx, pin_opts in self.col_with_options:
-            # set column pin values
-            for column, value in pin_opts:
-                column.output.value = value
-            for rx, pin_opts in self.row_with_options:
-                # set row in values
-                for row, value in pin_opts:
-                    row.output.value = value
-
-                # seem to need to pulse the clock to latch the columns
-                HardwareScan.clock.output.value = False
-                HardwareScan.clock.output.value = True
-
-                # see if we have a return value
-                if SoftwareScan.w_line.input.value is True:
-                    self.process(rx, cx)
+        kb_en = SoftwareScan.kb_en_mask
+
+        SIO[GPIO_OUT_CLR] = kb_en
+        state = self.state
+        scan_matrix(
+            SIO,
+            GPIO_OUT_SET,
+            GPIO_OUT_CLR,
+            HardwareScan.clock_mask,
+            SoftwareScan.w_line.input,
+            self.col_on,
+            self.col_off,
+            self.row_on,
+            self.row_off,
+            state,
+        )
+        SIO[GPIO_OUT_SET] = kb_en
 
-        SoftwareScan.kb_en.output.value = True
+        # only hand keys on once the scan is done, so HID reports
+        # don't stretch the timing of the scan itself
+        input_processor.input(state)
 
 
 class LED:
@@ -447,17 +651,18 @@ class BlinkLed:
     # leds = LED.leds
 
     def __init__(self):
+        # milliseconds between toggles
         self.pace = 1000
-        self.increment = 0
+        self.last_toggle = ticks_ms()
         for l in BlinkLed.leds:
             l.set_off()
 
     def try_toggle(self):
-        self.increment += 1
-        if self.increment == self.pace:
+        if ticks_diff(ticks_ms(), self.last_toggle) >= self.pace:
+            # step on by the pace rather than to now, so the blink doesn't drift
+            self.last_toggle = (self.last_toggle + self.pace) & TICKS_MAX
             for l in BlinkLed.leds:
                 l.toggle()
-                self.increment = 0
 
 
 class BBCKeyboardInterface:
@@ -475,7 +680,7 @@ class BBCKeyboardInterface:
 
         if self.hardware_scan is True:
             # if not using the hardware scan this needs to be off
-            SoftwareScan.kb_en.set_on()
+            SoftwareScan.kb_en.value = True
 
         # Case LEDs are flipped, enforce off to stop them being on by default
         LED.set_off()
@@ -492,7 +697,6 @@ class BBCKeyboardInterface:
         else:
             self.ss.check()
         break_button.check()
-        input_processor.check()
 
     def loop(self):
         # run the main function at 1MHZ